@@ -1,139 +1,265 @@
+import atexit
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 import streamlit as st
+from streamlit_autorefresh import st_autorefresh
 import requests
+import numpy as np
 import pandas as pd
 
+from polymarket_client import (
+    CANDIDATES,
+    clear_market_ids,
+    fetch_orderbooks_batch,
+    get_best_prices,
+    get_fetch_stats,
+    get_orderbooks,
+    load_market_ids,
+    match_candidate,
+    save_market_ids,
+    start_prewarm_thread,
+)
+
 st.set_page_config(
     page_title="🇵🇹 Polymarket – Portugal Presidential Election Tracker",
     layout="wide"
 )
+start_prewarm_thread()
 
 # ---- CONFIG ----
-EVENT_SLUG = "portugal-presidential-election"
-CANDIDATES = [
-    "Henrique Gouveia e Melo (IND)",
-    "Luís Marques Mendes (PSD)",
-    "António José Seguro (IND)",
-    "André Ventura (CH)",
-]
 THRESHOLD_LOW = 0.97
 THRESHOLD_HIGH = 1.03
-DEPTH = 100
+
+HISTORICAL_FILE = "historical_sums.csv"
+
+
+@st.cache_resource
+def _hist_handle():
+    """Process-wide append handle for the history CSV, closed at exit."""
+    write_header = not os.path.exists(HISTORICAL_FILE) or os.path.getsize(HISTORICAL_FILE) == 0
+    f = open(HISTORICAL_FILE, "a", buffering=8192, newline="")
+    if write_header:
+        f.write("timestamp,sum_bids,sum_asks\n")
+    atexit.register(f.close)
+    return f
+
+
+def append_historical(sum_bids, sum_asks):
+    """Append one timestamped row of basket sums to the history CSV.
+
+    Single-line write on a long-lived append handle: O(1) per refresh, no
+    DataFrame concat, no full-file rewrite, no per-write open/close. Each row
+    is flushed immediately — writes are already change-gated, so batching
+    flushes could lose hours of points on a crash to save nothing measurable.
+    """
+    f = _hist_handle()
+    f.write(f"{datetime.now().isoformat()},{sum_bids},{sum_asks}\n")
+    f.flush()
+
+
+# The chart only needs recent points, so cap how much of the (ever-growing)
+# CSV we read back: seek near the end and parse whole lines from there.
+_HIST_TAIL_BYTES = 256 * 1024
+_HIST_HEADER = "timestamp,sum_bids,sum_asks"
 
 
-# ---- FUNCTIONS ----
 @st.cache_data(ttl=300)
-def get_event_id(slug: str):
-    """Try to fetch the event_id from all known Polymarket endpoints."""
-    urls = [
-        "https://clob.polymarket.com/markets",
-        "https://clob.polymarket.com/events",
-    ]
-    for url in urls:
-        try:
-            resp = requests.get(url, timeout=10)
-            if resp.status_code != 200:
-                continue
-            data = resp.json()
-            # data may be list or dict
-            markets = data.get("markets") if isinstance(data, dict) else data
-            if not isinstance(markets, list):
-                continue
-            for m in markets:
-                if slug in str(m.get("slug", "")):
-                    return m.get("event_id")
-        except Exception:
-            continue
-    raise ValueError(f"Could not find event_id for slug '{slug}'")
+def load_historical():
+    """Load the recent tail of the history CSV for charting."""
+    try:
+        size = os.path.getsize(HISTORICAL_FILE)
+    except OSError:
+        return pd.DataFrame(columns=["sum_bids", "sum_asks"])
+    with open(HISTORICAL_FILE, "r", newline="") as f:
+        if size > _HIST_TAIL_BYTES:
+            f.seek(size - _HIST_TAIL_BYTES)
+            f.readline()  # discard the partial line we landed in
+        body = f.read()
+    if not body.startswith(_HIST_HEADER):
+        body = _HIST_HEADER + "\n" + body
+    return pd.read_csv(io.StringIO(body), index_col="timestamp", parse_dates=True)
 
 
-@st.cache_data(ttl=30)
-def get_orderbooks():
-    """Fetch all markets for the event."""
-    event_id = get_event_id(EVENT_SLUG)
-    url = f"https://clob.polymarket.com/markets?event_id={event_id}"
-    resp = requests.get(url)
-    resp.raise_for_status()
-
-    data = resp.json()
-    # Handle schema variations
-    if isinstance(data, dict):
-        markets = data.get("markets") or data.get("data")
-    elif isinstance(data, list):
-        markets = data
+LAST_GOOD_MAX_AGE = 300  # seconds a stale snapshot stays servable
+
+
+def _resolve_matched():
+    """Resolve (candidate, market) pairs, preferring the persisted id map.
+
+    Returns (matched, from_cache): with a complete id map the listing call is
+    skipped entirely and minimal {"id": …} market stubs are used.
+    """
+    ids_map = load_market_ids()
+    if ids_map and set(ids_map) >= set(CANDIDATES):
+        return [(cand, {"id": ids_map[cand]}) for cand in CANDIDATES], True
+    markets = get_orderbooks()
+    by_candidate = {}
+    for q, m in markets.items():
+        cand = match_candidate(q)
+        if cand and cand not in by_candidate:
+            by_candidate[cand] = m
+    matched = [(cand, by_candidate[cand]) for cand in CANDIDATES if cand in by_candidate]
+    ids_map = {cand: m.get("id") or m.get("market_id") for cand, m in matched}
+    if len(ids_map) == len(CANDIDATES) and all(ids_map.values()):
+        save_market_ids(ids_map)
+    return matched, False
+
+
+def _rows_for(matched):
+    """Fetch prices for the matched markets and build the row tuples."""
+    if not matched:
+        return ()
+    # One batched /books call covers every candidate; fall back to the
+    # concurrent per-market GETs when the batch endpoint is unhappy.
+    books = {}
+    ids = [m.get("id") or m.get("market_id") for _, m in matched]
+    if all(ids) and len(ids) > 1:
+        try:
+            books = fetch_orderbooks_batch(tuple(ids))
+        except requests.RequestException:
+            books = {}
+    if books:
+        prices = [
+            get_best_prices(m, books.get(m.get("id") or m.get("market_id")))
+            for _, m in matched
+        ]
     else:
-        raise ValueError("Unexpected API format.")
-
-    if not isinstance(markets, list):
-        raise ValueError("Markets data missing or invalid.")
-
-    result = {}
-    for m in markets:
-        q = m.get("question") or m.get("title") or m.get("slug") or str(m)
-        result[q] = m
-    return result
-
-
-def top_price_with_volume(orders, target_volume=DEPTH):
-    """Compute volume-weighted average up to a given depth."""
-    if not orders:
-        return None
-    filled, weighted = 0, 0
-    for o in orders:
-        v = min(target_volume - filled, o.get("size", 0))
-        weighted += o.get("price", 0) * v
-        filled += v
-        if filled >= target_volume:
-            break
-    return weighted / filled if filled else None
-
-
-def get_best_prices(market):
-    """Fetch orderbook if not embedded."""
-    orderbook = market.get("orderbook")
-    if not orderbook:
-        market_id = market.get("id") or market.get("market_id")
-        if not market_id:
-            return None, None
-        ob_url = f"https://clob.polymarket.com/orderbook?market={market_id}"
-        ob_resp = requests.get(ob_url)
-        if ob_resp.status_code != 200:
-            return None, None
-        orderbook = ob_resp.json()
-    bids, asks = orderbook.get("bids", []), orderbook.get("asks", [])
-    return top_price_with_volume(bids), top_price_with_volume(asks)
+        with ThreadPoolExecutor(max_workers=len(matched)) as pool:
+            prices = list(pool.map(lambda cm: get_best_prices(cm[1]), matched))
+    return tuple((cand, bid, ask) for (cand, _), (bid, ask) in zip(matched, prices))
+
+
+# TTL slightly under the default 30 s refresh: the periodic tick recomputes,
+# but reruns from unrelated UI interaction hit the cache.
+@st.cache_data(ttl=25, show_spinner=False)
+def fetch_candidate_rows():
+    """Fetch and assemble raw (candidate, bid, ask) rows for each candidate."""
+    matched, from_cache = _resolve_matched()
+    rows = _rows_for(matched)
+    if from_cache and rows and all(bid is None and ask is None for _, bid, ask in rows):
+        # Persisted ids stopped resolving to live books; drop them and
+        # re-resolve from the listing once.
+        clear_market_ids()
+        matched, _ = _resolve_matched()
+        rows = _rows_for(matched)
+    return rows
 
 
 def get_market_data():
-    """Return bid/ask for each candidate."""
-    markets = get_orderbooks()
-    rows = []
-    for cand in CANDIDATES:
-        # Try flexible matching (API questions often vary slightly)
-        match = next((m for k, m in markets.items() if cand.lower() in k.lower()), None)
-        if not match:
-            continue
-        bid, ask = get_best_prices(match)
-        rows.append({"Candidate": cand, "Bid": bid, "Ask": ask})
-    return pd.DataFrame(rows)
+    """Return raw (candidate, bid, ask) rows for each candidate.
+
+    On API failure, fall back to the last good snapshot (kept in
+    st.session_state) so a transient outage doesn't wipe the dashboard.
+    Returns (rows, stale) where stale is True when serving the fallback.
+    """
+    try:
+        rows = fetch_candidate_rows()
+        if rows:
+            st.session_state["last_good"] = (rows, time.time())
+        return rows, False
+    except Exception:
+        last_good = st.session_state.get("last_good")
+        if last_good is not None:
+            rows, ts = last_good
+            if time.time() - ts < LAST_GOOD_MAX_AGE:
+                return rows, True
+        raise
+
+
+@st.cache_data(ttl=30)
+def build_view(rows):
+    """Build the display frame and basket sums for a distinct set of rows.
+
+    Keyed on the row values, so reruns caused by UI interaction reuse the
+    built DataFrame instead of reconstructing it.
+    """
+    if not rows:
+        return pd.DataFrame(columns=["Candidate", "Bid", "Ask"]), 0.0, 0.0
+    # Column-wise construction: one constructor call, dtypes inferred per
+    # column rather than per row.
+    names, bids, asks = zip(*rows)
+    df = pd.DataFrame({"Candidate": names, "Bid": bids, "Ask": asks})
+    return df, df["Bid"].sum(skipna=True), df["Ask"].sum(skipna=True)
 
 
 # ---- STREAMLIT UI ----
 st.title("🇵🇹 Polymarket – Portugal Presidential Election Tracker")
 st.caption("Tracks the sum of bids and asks for top candidates. Data from Polymarket’s public CLOB API.")
 
+_MID_WINDOW = 10  # basket midpoints kept for the volatility estimate
+
+
+def adaptive_interval_ms(base_seconds):
+    """Stretch the refresh interval when the market has gone quiet.
+
+    Uses the std-dev of the recent basket midpoints (tracked across reruns in
+    st.session_state): below a tenth of a cent of movement, polling slows to
+    4x the configured interval, capped at 5 minutes. Any volatility snaps it
+    back to the slider value.
+    """
+    window = st.session_state.get("mid_window", ())
+    if len(window) < 5 or float(np.std(window)) >= 1e-3:
+        return base_seconds * 1000
+    return min(base_seconds * 4, 300) * 1000
+
+
 interval = st.slider("Auto-refresh interval (seconds)", 10, 120, 30)
 
-try:
-    df = get_market_data()
-    if df.empty:
-        st.warning("No market data found. Try again later or check event slug.")
-    else:
-        sum_bids = df["Bid"].sum(skipna=True)
-        sum_asks = df["Ask"].sum(skipna=True)
+# Off by default so the sidebar stays empty for normal viewers; the stats
+# make it easy to confirm caching is pulling its weight in production.
+if st.sidebar.checkbox("Show debug stats", value=False):
+    stats = get_fetch_stats()
+    st.sidebar.subheader("Fetch stats")
+    st.sidebar.metric("HTTP requests", stats["requests"])
+    st.sidebar.metric("304 Not Modified", stats["not_modified"])
+    st.sidebar.metric("ETag cache entries", stats["etag_entries"])
+    if stats["last_fetch"]:
+        age = time.time() - stats["last_fetch"]
+        st.sidebar.caption(f"Last fetch: {age:.0f}s ago")
+
+def _render_live():
+    """Render the live-price panel: metrics, thresholds, tables and charts.
+
+    Kept in its own function so it can run as a fragment: the metadata layers
+    above it (event id, market listing, persisted id map) are cached for
+    minutes to hours, so a fragment rerun only touches the orderbook calls.
+    """
+    # st.rerun raises a control-flow exception, so it must fire outside the
+    # broad error handler below — record the need here, act after the try.
+    needs_rerun = False
+    try:
+        rows, stale = get_market_data()
+        if stale:
+            st.caption("⏳ Showing last known data – live fetch failed, retrying on next refresh.")
+        df, sum_bids, sum_asks = build_view(rows)
+        if df.empty:
+            st.warning("No market data found. Try again later or check event slug.")
+            return
+        window = st.session_state.get("mid_window", ())
+        st.session_state["mid_window"] = (window + ((sum_bids + sum_asks) / 2,))[-_MID_WINDOW:]
+
+        # run_every is frozen at fragment registration, but the adaptive
+        # interval tracks volatility measured in here. When the two disagree,
+        # schedule a full script run so the fragment is re-registered with
+        # the freshly computed cadence.
+        if _USE_FRAGMENT and adaptive_interval_ms(interval) != st.session_state.get("live_run_ms"):
+            needs_rerun = True
+
+        # Deltas against the previous refresh, carried in session_state so a
+        # rerun shows movement instead of a context-free snapshot.
+        prev = st.session_state.get("prev_sums")
+        bid_delta = f"{sum_bids - prev[0]:+.3f}" if prev else None
+        ask_delta = f"{sum_asks - prev[1]:+.3f}" if prev else None
+        if not stale:
+            st.session_state["prev_sums"] = (sum_bids, sum_asks)
 
         col1, col2 = st.columns(2)
-        col1.metric("Sum of Best Bids", f"{sum_bids:.3f}")
-        col2.metric("Sum of Best Asks", f"{sum_asks:.3f}")
+        col1.metric("Sum of Best Bids", f"{sum_bids:.3f}", delta=bid_delta)
+        col2.metric("Sum of Best Asks", f"{sum_asks:.3f}", delta=ask_delta)
 
         if sum_bids < THRESHOLD_LOW:
             st.warning(f"Market Undervalued (< {THRESHOLD_LOW}) → possible long arb opportunity")
@@ -142,10 +268,47 @@ try:
         else:
             st.success("Market within normal bounds.")
 
-        st.dataframe(df.round(3), use_container_width=True)
+        st.dataframe(
+            df.style.format({"Bid": "{:.3f}", "Ask": "{:.3f}"}, na_rep="–"),
+            use_container_width=True,
+        )
+        st.bar_chart(df.set_index("Candidate")[["Bid", "Ask"]])
+
+        # The CSV is only parsed once per session; afterwards new rows go to
+        # both the in-memory frame and (append-only) to disk.
+        if "hist" not in st.session_state:
+            st.session_state["hist"] = load_historical()
+        # Only log when the sums actually moved: quiet periods would otherwise
+        # fill the history with identical rows every refresh.
+        hist_key = (round(sum_bids, 4), round(sum_asks, 4))
+        if not stale and st.session_state.get("last_hist") != hist_key:
+            append_historical(sum_bids, sum_asks)
+            st.session_state["last_hist"] = hist_key
+            st.session_state["hist"].loc[pd.Timestamp.now()] = [sum_bids, sum_asks]
+        hist = st.session_state["hist"]
+        if not hist.empty:
+            st.line_chart(hist)
+
+    except Exception as e:
+        st.error(f"⚠️ Error fetching market data: {e}")
+
+    if needs_rerun:
+        try:
+            st.rerun(scope="app")
+        except TypeError:  # scope= needs Streamlit ≥1.37
+            st.rerun()
+
 
-except Exception as e:
-    st.error(f"⚠️ Error fetching market data: {e}")
+# Prefer a fragment (Streamlit 1.33+): only the live panel re-runs on the
+# timer, leaving the title, slider and sidebar untouched. On older Streamlit
+# fall back to the client-side autorefresh, which reruns the whole script.
+_USE_FRAGMENT = hasattr(st, "fragment")
+if _USE_FRAGMENT:
+    _run_ms = adaptive_interval_ms(interval)
+    st.session_state["live_run_ms"] = _run_ms
+    _render_live = st.fragment(run_every=_run_ms / 1000)(_render_live)
+else:
+    st_autorefresh(interval=adaptive_interval_ms(interval), key="refresh")
+_render_live()
 
 st.caption("Auto-refresh enabled. Updates every few seconds automatically.")
-st.experimental_rerun()
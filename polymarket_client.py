@@ -0,0 +1,487 @@
+"""Shared Polymarket API client for the Portugal election tracker.
+
+Holds the HTTP session, endpoint fetchers, candidate matching and orderbook
+math so the Streamlit app stays a thin UI layer and every deployment shares
+one cache namespace for these functions.
+"""
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import deque
+from functools import lru_cache
+
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+
+try:
+    # C-based parser, 2-5x faster on the big market listings; fall back to
+    # stdlib json when it isn't installed.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # Optional JIT for the fill walk: early-exits at the crossing level and
+    # skips the cumsum allocation. The NumPy path below is the supported
+    # default; install numba to opt in on deep-book deployments.
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _walk_fill(prices, sizes, need):
+        total = 0.0
+        filled = 0.0
+        for i in range(prices.size):
+            take = min(sizes[i], need - filled)
+            total += take * prices[i]
+            filled += take
+            if filled >= need:
+                break
+        if filled <= 0.0:
+            return -1.0
+        return total / filled
+
+else:
+    _walk_fill = None
+
+# ---- CONFIG ----
+EVENT_SLUG = "portugal-presidential-election"
+HEADERS = {"User-Agent": "polymarket-portugal-tracker/1.0", "Accept": "application/json"}
+CANDIDATES = [
+    "Henrique Gouveia e Melo (IND)",
+    "Luís Marques Mendes (PSD)",
+    "António José Seguro (IND)",
+    "André Ventura (CH)",
+]
+DEPTH = 100
+
+def _norm(s):
+    """Normalize a name for matching: strip accents, casefold, squeeze spaces.
+
+    Upstream question strings occasionally arrive with mangled or missing
+    accents ("Luís" vs "Luis"), so comparisons happen on the ASCII-folded
+    form of both sides.
+    """
+    s = unicodedata.normalize("NFKD", s or "").encode("ascii", "ignore").decode()
+    return " ".join(s.casefold().split())
+
+
+# Candidate display names carry a party tag ("… (IND)") that never appears in
+# market questions; match on the normalized bare name.
+CANDIDATE_BY_NAME = {_norm(cand.split(" (")[0]): cand for cand in CANDIDATES}
+
+_QUESTION_RE = re.compile(r"will\s+(.+?)\s+win", re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def extract_candidate_name(question):
+    """Pull the candidate name out of a 'Will X win …' market question.
+
+    Pure function of the question string, and the same ~dozen questions come
+    back every refresh, so a small LRU cache skips the regex entirely.
+    """
+    question = question or ""
+    # Cheap substring scan first: most non-matching titles lack "win" at all,
+    # and a str search is faster than entering the regex engine.
+    if "win" not in question.lower():
+        return None
+    m = _QUESTION_RE.search(question)
+    return m.group(1).strip() if m else None
+
+
+def match_candidate(question):
+    """Map a market question to its configured candidate, or None."""
+    name = extract_candidate_name(question)
+    if name and _norm(name) in CANDIDATE_BY_NAME:
+        return CANDIDATE_BY_NAME[_norm(name)]
+    # Fallback for titles that don't follow the "Will X win" shape.
+    q = _norm(question)
+    return next((full for bare, full in CANDIDATE_BY_NAME.items() if bare in q), None)
+
+
+@st.cache_resource
+def get_session():
+    """One pooled HTTP session per process, shared across sessions/users."""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries),
+    )
+    return session
+
+
+# Polite per-process rate limiting: requests only block when the recent rate
+# would exceed _MAX_QPS, never unconditionally. Lock-guarded because the
+# fallback fetch path runs from a thread pool.
+_MAX_QPS = 10
+_RATE = deque(maxlen=_MAX_QPS)
+_RATE_LOCK = threading.Lock()
+
+
+def _rate_limit():
+    while True:
+        with _RATE_LOCK:
+            now = time.monotonic()
+            if len(_RATE) < _MAX_QPS or now - _RATE[0] >= 1.0:
+                _RATE.append(now)
+                return
+            wait = 1.0 - (now - _RATE[0])
+        time.sleep(wait)
+
+
+# Conditional GETs: remember each URL's ETag and decoded payload so an
+# unchanged response comes back as a ~200-byte 304 with no body to re-parse.
+_ETAG_CACHE = {}
+_ETAG_LOCK = threading.Lock()
+
+# Lightweight fetch counters for the debug sidebar: how many requests went
+# out, how many came back as 304s, and when the last one completed. Updated
+# under _ETAG_LOCK since the same paths already hold it.
+_FETCH_STATS = {"requests": 0, "not_modified": 0, "last_fetch": None}
+
+
+def get_fetch_stats():
+    """Snapshot the fetch counters and ETag-cache size for diagnostics."""
+    with _ETAG_LOCK:
+        stats = dict(_FETCH_STATS)
+        stats["etag_entries"] = len(_ETAG_CACHE)
+    return stats
+
+
+def robust_fetch(url: str, timeout: int = 10):
+    """GET a JSON endpoint through the pooled session, raising on HTTP errors."""
+    _rate_limit()
+    with _ETAG_LOCK:
+        cached = _ETAG_CACHE.get(url)
+        _FETCH_STATS["requests"] += 1
+        _FETCH_STATS["last_fetch"] = time.time()
+    headers = {"If-None-Match": cached[0]} if cached else None
+    resp = get_session().get(url, timeout=timeout, headers=headers)
+    if resp.status_code == 304 and cached:
+        with _ETAG_LOCK:
+            _FETCH_STATS["not_modified"] += 1
+        return cached[1]
+    resp.raise_for_status()
+    # Decode from bytes directly: skips requests' charset detection and the
+    # bytes->str copy that resp.json() would do.
+    payload = json_loads(resp.content)
+    etag = resp.headers.get("ETag")
+    if etag:
+        with _ETAG_LOCK:
+            _ETAG_CACHE[url] = (etag, payload)
+    return payload
+
+
+# The four target market ids never change once the event is live; persist
+# them so warm paths (and cold starts) can skip the listing call entirely.
+IDS_CACHE_FILE = "ids_cache.json"
+
+
+def load_market_ids():
+    """Return the persisted {candidate: market_id} map, or {} if absent/bad."""
+    try:
+        with open(IDS_CACHE_FILE, "rb") as f:
+            ids = json_loads(f.read())
+        return ids if isinstance(ids, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_market_ids(ids):
+    """Persist the resolved {candidate: market_id} map for later cold starts."""
+    try:
+        with open(IDS_CACHE_FILE, "w") as f:
+            json.dump(ids, f)
+    except OSError:
+        pass
+
+
+def clear_market_ids():
+    """Drop the persisted id map, e.g. after the ids stop resolving."""
+    try:
+        os.remove(IDS_CACHE_FILE)
+    except OSError:
+        pass
+
+
+# Streaming fast path for get_event_id: spot the target slug and the
+# event_id of the same market object without materializing the full listing.
+_SCAN_BUF_MAX = 128 * 1024
+
+
+def _scan_stream_for_event_id(resp, slug: str):
+    """Regex-scan a streamed listing for the slug's event_id.
+
+    Keeps at most _SCAN_BUF_MAX bytes buffered so peak memory stays constant
+    regardless of response size. Returns None if the pattern never shows up.
+    """
+    # The id must be followed by a delimiter already in the buffer; without
+    # one, a chunk boundary inside the value would yield a truncated match
+    # (which, being truthy, would also suppress the full-parse fallback).
+    pattern = re.compile(
+        rb'"slug"\s*:\s*"[^"]*' + re.escape(slug.encode()) + rb'[^"]*"[^{}]*?'
+        rb'"event_id"\s*:\s*"?([0-9A-Za-z_-]+)(?=["\s,}\]])'
+    )
+    buf = b""
+    for chunk in resp.iter_content(64 * 1024):
+        buf += chunk
+        m = pattern.search(buf)
+        if m:
+            return m.group(1).decode()
+        buf = buf[-_SCAN_BUF_MAX:]
+    return None
+
+
+# Event ids never change once the event is live; persist across restarts so
+# a cold process doesn't redo the listing scan.
+@st.cache_data(ttl=3600, persist="disk", show_spinner=False)
+def get_event_id(slug: str):
+    """Try to fetch the event_id from all known Polymarket endpoints."""
+    urls = [
+        "https://clob.polymarket.com/markets",
+        "https://clob.polymarket.com/events",
+    ]
+    for url in urls:
+        try:
+            # Fast path: stream and scan, so the multi-MB listing never has to
+            # sit in memory at once.
+            with get_session().get(url, timeout=10, stream=True) as resp:
+                if resp.status_code != 200:
+                    continue
+                event_id = _scan_stream_for_event_id(resp, slug)
+            if event_id:
+                return event_id
+            # Fallback: full fetch + parse, tolerant of schema variations.
+            resp = get_session().get(url, timeout=10)
+            if resp.status_code != 200:
+                continue
+            data = resp.json()
+            # data may be list or dict
+            markets = data.get("markets") if isinstance(data, dict) else data
+            if not isinstance(markets, list):
+                continue
+            for m in markets:
+                if slug in str(m.get("slug", "")):
+                    return m.get("event_id")
+        except (requests.RequestException, ValueError):
+            # Try the next endpoint; anything else (KeyboardInterrupt,
+            # programming errors) should propagate.
+            continue
+    raise ValueError(f"Could not find event_id for slug '{slug}'")
+
+
+# Keep the heavy listing warm from a background thread so a user-facing
+# refresh lands on a hot ETag entry (cheap 304) instead of paying the full
+# fetch when the cache TTL lapses. Deliberately below the 300 s listing TTL.
+_PREWARM_INTERVAL = 240
+
+
+@st.cache_resource
+def start_prewarm_thread():
+    """Start the per-process daemon that re-primes the listing's ETag cache.
+
+    Only uncached module-level helpers run on the thread — st.cache_data
+    functions stay on script threads where Streamlit expects them.
+    """
+
+    def _loop():
+        while True:
+            time.sleep(_PREWARM_INTERVAL)
+            with contextlib.suppress(Exception):
+                robust_fetch("https://clob.polymarket.com/markets")
+
+    thread = threading.Thread(target=_loop, daemon=True, name="listing-prewarm")
+    thread.start()
+    return thread
+
+
+def _extract_markets(data):
+    """Pull the market list out of a listing payload; None if the shape is off."""
+    if isinstance(data, dict):
+        data = data.get("markets") or data.get("data")
+    return data if isinstance(data, list) else None
+
+
+def _filter_targets(markets):
+    """Keep only target-candidate markets, keyed by question.
+
+    Filtering here, before anything downstream can issue a per-market HTTP
+    call, means non-target markets never leave the listing layer.
+    """
+    result = {}
+    found = set()
+    for m in markets:
+        q = m.get("question") or m.get("title") or m.get("slug") or str(m)
+        cand = match_candidate(q)
+        if cand:
+            result[q] = m
+            found.add(cand)
+            # Every tracked candidate is matched — the rest of the listing
+            # (often hundreds of unrelated markets) can't add anything.
+            if len(found) == len(CANDIDATES):
+                break
+    return result
+
+
+# The market set for an event changes on the scale of hours; prices change in
+# seconds. Cache the listing long and the per-market orderbooks short, so a
+# steady refresh only re-fetches the 4 small orderbook payloads.
+@st.cache_data(ttl=300)
+def get_orderbooks():
+    """Fetch the event's candidate markets.
+
+    Single-shot: the full listing already contains this event's markets, so
+    filter it directly rather than resolving an event_id and re-fetching the
+    same listing scoped to it (two round trips for one payload's worth of
+    data). The scoped fetch survives as a fallback for schema drift.
+    """
+    try:
+        markets = _extract_markets(robust_fetch("https://clob.polymarket.com/markets"))
+        if markets:
+            result = _filter_targets(markets)
+            if result:
+                return result
+    except requests.RequestException:
+        pass
+
+    event_id = get_event_id(EVENT_SLUG)
+    data = robust_fetch(f"https://clob.polymarket.com/markets?event_id={event_id}")
+    markets = _extract_markets(data)
+    if markets is None:
+        raise ValueError("Markets data missing or invalid.")
+    return _filter_targets(markets)
+
+
+def _safe_float(v):
+    """Coerce an API number (float, int or numeric string) to float.
+
+    Fast-paths the already-float case; junk becomes 0.0 instead of raising,
+    so one malformed level can't take down a whole book parse.
+    """
+    if type(v) is float:
+        return v
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def calculate_fill_price(orders, target_volume=DEPTH):
+    """Compute volume-weighted average up to a given depth.
+
+    Vectorized: one cumulative sum over the sizes locates the crossing level,
+    one dot product gives the fill cost — no Python-level walk over the book.
+    """
+    if not orders:
+        return None
+    n = len(orders)
+    prices = np.fromiter((_safe_float(o.get("price")) for o in orders), np.float64, count=n)
+    sizes = np.fromiter((_safe_float(o.get("size")) for o in orders), np.float64, count=n)
+    if _walk_fill is not None:
+        vwap = _walk_fill(prices, sizes, float(target_volume))
+        return None if vwap < 0.0 else vwap
+    cum = np.cumsum(sizes)
+    filled = min(cum[-1], target_volume)
+    if filled <= 0:
+        return None
+    idx = int(np.searchsorted(cum, filled))
+    # Cost of the fully consumed levels plus the partial top level; no
+    # temporary size array needed.
+    full = float(prices[:idx] @ sizes[:idx])
+    partial = float(prices[idx]) * (filled - (cum[idx - 1] if idx > 0 else 0.0))
+    return (full + partial) / filled
+
+
+def fill_prices(orderbook, target_volume=DEPTH):
+    """Compute (bid_vwap, ask_vwap) for one book in a single call.
+
+    Shared kernel for both sides: one shape check, then the vectorized fill
+    on each side's levels.
+    """
+    try:
+        bids, asks = orderbook["bids"], orderbook["asks"]
+    except (KeyError, TypeError):
+        return None, None
+    return (
+        calculate_fill_price(bids, target_volume),
+        calculate_fill_price(asks, target_volume),
+    )
+
+
+@st.cache_data(ttl=30)
+def fetch_orderbook(market_id):
+    """Fetch one market's orderbook, cached per market id."""
+    return robust_fetch(f"https://clob.polymarket.com/orderbook?market={market_id}")
+
+
+@st.cache_data(ttl=30)
+def fetch_orderbooks_batch(market_ids):
+    """Fetch several orderbooks in one POST /books call, keyed by market id."""
+    _rate_limit()
+    resp = get_session().post(
+        "https://clob.polymarket.com/books",
+        json=[{"market": mid} for mid in market_ids],
+        timeout=10,
+    )
+    resp.raise_for_status()
+    books = json_loads(resp.content)
+    if not isinstance(books, list):
+        return {}
+    return {b.get("market") or b.get("asset_id"): b for b in books if isinstance(b, dict)}
+
+
+@st.cache_data(ttl=30)
+def fetch_top_of_book(market_id):
+    """Approximate bid/ask from the scalar /midpoint and /spread endpoints.
+
+    ~50-byte payloads with no book to walk; used when a market's orderbook is
+    empty or missing so the dashboard still shows a price.
+    """
+    try:
+        mid = robust_fetch(f"https://clob.polymarket.com/midpoint?market={market_id}")
+        spread = robust_fetch(f"https://clob.polymarket.com/spread?market={market_id}")
+    except requests.RequestException:
+        return None, None
+    try:
+        mid = float(mid.get("mid") if isinstance(mid, dict) else mid)
+        spread = float(spread.get("spread") if isinstance(spread, dict) else spread)
+    except (TypeError, ValueError):
+        return None, None
+    return mid - spread / 2, mid + spread / 2
+
+
+def get_best_prices(market, orderbook=None):
+    """Compute bid/ask from a prefetched orderbook, fetching it if needed."""
+    market_id = market.get("id") or market.get("market_id")
+    if orderbook is None:
+        orderbook = market.get("orderbook")
+    if not orderbook:
+        if not market_id:
+            return None, None
+        try:
+            orderbook = fetch_orderbook(market_id)
+        except requests.RequestException:
+            return None, None
+    bid, ask = fill_prices(orderbook)
+    if bid is None and ask is None and market_id:
+        return fetch_top_of_book(market_id)
+    return bid, ask